@@ -1,38 +1,94 @@
 import argparse
 import logging
 from pathlib import Path
+from statistics import NormalDist
+from typing import Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+from dashprep.graph import JourneyStore, get_edges
+from dashprep.profiling import add_profile_arguments, get_profiler
+from dashprep.sketch import DEFAULT_PRECISION, SketchTable
+
 
 logger = logging.getLogger(Path(__file__).stem)
 
 
-def get_global_stats(df: pd.DataFrame) -> pd.Series:
+EDGE_KEY_COLUMNS = [
+    'url_subdomain', 'source_type',
+    'from_node', 'from_node_type',
+    'to_node', 'to_node_type',
+]
+
+
+def get_journeys(store: JourneyStore) -> pd.DataFrame:
+    """Calculates journey-level outcome, steps and time
+    (and the IP address, if known).
+    A journey is abandoned if it stops without reaching a terminator phase
+    (the cart by default).
+    """
+
+    last = store.offsets[1:] - 1
+    abandoned = ~np.isin(store.nodes.phase[store.from_node[last]],
+                         store.rules.terminator_levels)
+
+    journeys = pd.DataFrame({
+        'abandoned': abandoned,
+        'total_steps': store.total_steps,
+        'total_time': store.total_time,
+    }, index=pd.Index(store.strings.decode(store.journey_id), name='journey_id'))
+    if store.ip is not None:
+        journeys['ip'] = store.strings.decode(store.ip)
+    return journeys
+
+
+def get_journey_totals(journeys: pd.DataFrame) -> pd.DataFrame:
+    """Counts the journeys and sums their steps and time by outcome.
+    Totals of several sets of journeys can be added up.
+    """
+
+    abandoned = journeys['abandoned'].to_numpy(dtype=bool)
+    totals = pd.DataFrame(
+        [(int(np.count_nonzero(abandoned == flag)),
+          journeys.loc[abandoned == flag, 'total_steps'].sum(),
+          journeys.loc[abandoned == flag, 'total_time'].sum())
+         for flag in (False, True)],
+        index=pd.Index([False, True], name='abandoned'),
+        columns=['n', 'total_steps', 'total_time'])
+    return totals
+
+
+def get_global_stats(journeys: pd.DataFrame) -> pd.Series:
     """Calculates journey-level stats.
     """
 
-    journeys = df.groupby(['journey_id']).agg(
-        abandoned=('abandoned', 'max'),
-        total_steps=('total_steps', 'max'),
-        total_time=('total_time', 'max'),
-    )
+    return get_global_stats_from_totals(get_journey_totals(journeys))
+
+
+def get_global_stats_from_totals(totals: pd.DataFrame) -> pd.Series:
+    """Calculates journey-level stats from the journey totals.
+    """
 
     d = pd.Series(dtype=float, name='value')
     d.index.name = 'name'
 
-    d['visitors'] = len(journeys)
+    d['visitors'] = totals['n'].sum()
 
-    d['browse_abandonment_n'] = journeys['abandoned'].sum()
-    d['browse_abandonment_pct'] = d['browse_abandonment_n'] / d['visitors']
-    d['avg_steps_abandonment'] = journeys.loc[journeys['abandoned'], 'total_steps'].mean()
-    d['avg_time_abandonment'] = journeys.loc[journeys['abandoned'], 'total_time'].mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d['browse_abandonment_n'] = totals.loc[True, 'n']
+        d['browse_abandonment_pct'] = d['browse_abandonment_n'] / d['visitors']
+        d['avg_steps_abandonment'] = (totals.loc[True, 'total_steps']
+                                      / totals.loc[True, 'n'])
+        d['avg_time_abandonment'] = (totals.loc[True, 'total_time']
+                                     / totals.loc[True, 'n'])
 
-    d['cart_conversion_n'] = d['visitors'] - d['browse_abandonment_n']
-    d['cart_conversion_pct'] = 1 - d['browse_abandonment_pct']
-    d['avg_steps_cart_conversion'] = journeys.loc[~journeys['abandoned'],
-                                                  'total_steps'].mean()
-    d['avg_time_cart_conversion'] = journeys.loc[~journeys['abandoned'], 'total_time'].mean()
+        d['cart_conversion_n'] = d['visitors'] - d['browse_abandonment_n']
+        d['cart_conversion_pct'] = 1 - d['browse_abandonment_pct']
+        d['avg_steps_cart_conversion'] = (totals.loc[False, 'total_steps']
+                                          / totals.loc[False, 'n'])
+        d['avg_time_cart_conversion'] = (totals.loc[False, 'total_time']
+                                         / totals.loc[False, 'n'])
 
     d['sales_conversion_n'] = 0
     d['sales_conversion_pct'] = 0
@@ -44,36 +100,254 @@ def get_global_stats(df: pd.DataFrame) -> pd.Series:
     return d
 
 
-def get_weighted_edges(df: pd.DataFrame) -> pd.DataFrame:
+def _group_edges(store: JourneyStore) -> Tuple[np.ndarray, pd.DataFrame]:
+    """Groups the events by packed integer keys
+    (subdomain, source type, edge) and decodes the names of the groups.
+
+    Returns the group index of each event and the groups with frequency.
+    """
+
+    jix = store.event_journey()
+    n_nodes = len(store.nodes)
+    edge, edge_uniques = pd.factorize(
+        store.from_node.astype(np.int64) * n_nodes + store.node)
+    subdomain, subdomain_uniques = pd.factorize(store.url_subdomain[jix])
+    source, source_uniques = pd.factorize(store.source_type)
+
+    dims = (len(subdomain_uniques), len(source_uniques), len(edge_uniques))
+    keys, group, freq = np.unique(
+        np.ravel_multi_index((subdomain, source, edge), dims),
+        return_inverse=True, return_counts=True)
+    subdomain, source, edge = np.unravel_index(keys, dims)
+    from_node, to_node = np.divmod(edge_uniques[edge], n_nodes)
+
+    edges = pd.DataFrame({
+        'url_subdomain': store.strings.decode(subdomain_uniques[subdomain]),
+        'source_type': store.strings.decode(source_uniques[source]),
+        'from_node': store.nodes.names(from_node, missing='START'),
+        'from_node_type': store.nodes.types(from_node),
+        'to_node': store.nodes.names(to_node),
+        'to_node_type': store.nodes.types(to_node),
+        'freq': freq,
+    })
+
+    return group, edges
+
+
+def get_weighted_edges(store: JourneyStore) -> pd.DataFrame:
     """Compresses edges using node names.
+    Edges are counted on packed integer keys, names are decoded afterwards.
     """
 
-    edges = df.groupby(
-        ['url_subdomain', 'source_type',
-         'from_node', 'from_node_type',
-         'to_node', 'to_node_type'],
-        dropna=False)['freq'].sum().reset_index()
+    __, edges = _group_edges(store)
+
+    return merge_weighted_edges(edges)
+
+
+def get_edge_sketches(store: JourneyStore,
+                      precision: int = DEFAULT_PRECISION,
+                      sample_rate: Optional[float] = None) -> SketchTable:
+    """Builds distinct visitor sketches per edge
+    (of a sample of the visitors if the sample rate is given).
+    """
+
+    if store.visitor is None:
+        raise ValueError('Visitor hashes are required for sketches.')
+
+    group, edges = _group_edges(store)
+    sketches = SketchTable.from_groups(
+        edges[EDGE_KEY_COLUMNS], group,
+        store.visitor[store.event_journey()], precision,
+        1. if sample_rate is None else sample_rate)
+
+    return sketches.rollup(EDGE_KEY_COLUMNS)
+
+
+def add_unique_visitors(edges: pd.DataFrame,
+                        sketches: SketchTable) -> pd.DataFrame:
+    """Adds the estimated distinct visitors of the edges,
+    their endpoint nodes and source types from the edge sketches.
+    Node sketches are the union of the edges touching the node.
+    """
+
+    node_columns = ['url_subdomain', 'source_type', 'node', 'node_type']
+    sides = []
+    for side in ['from', 'to']:
+        keys = sketches.keys.rename(columns={f'{side}_node': 'node',
+                                             f'{side}_node_type': 'node_type'})
+        sides.append(SketchTable(keys[node_columns], sketches.registers,
+                                 sketches.sample_rate))
+    nodes = SketchTable.union(sides).to_frame('unique_visitors')
+    sources = (sketches.rollup(['url_subdomain', 'source_type'])
+               .to_frame('source_type_unique_visitors'))
+
+    edges = edges.merge(sketches.to_frame('unique_visitors'),
+                        how='left', on=EDGE_KEY_COLUMNS)
+    for side in ['from', 'to']:
+        edges = edges.merge(
+            nodes.rename(columns={
+                'node': f'{side}_node', 'node_type': f'{side}_node_type',
+                'unique_visitors': f'{side}_node_unique_visitors'}),
+            how='left',
+            on=['url_subdomain', 'source_type',
+                f'{side}_node', f'{side}_node_type'])
+    edges = edges.merge(sources, how='left',
+                        on=['url_subdomain', 'source_type'])
 
     return edges
 
 
-def analyze(df: pd.DataFrame) -> pd.DataFrame:
-    """Calculates global stats and weighted edges.
+def merge_weighted_edges(edges: pd.DataFrame) -> pd.DataFrame:
+    """Sums the frequencies of weighted edges with the same endpoints
+    (e.g. results of several partitions).
     """
 
-    df['abandoned'] = (df['to_node'] == 'STOP') & (df['from_node'] != 'CART')
-    df['freq'] = 1
+    edges = edges.groupby(EDGE_KEY_COLUMNS, dropna=False)['freq'].sum().reset_index()
 
-    stats_global = get_global_stats(df)
-    edges = get_weighted_edges(df)
+    return edges
+
+
+def get_ip_totals(journeys: pd.DataFrame) -> Optional[pd.Series]:
+    """Sums the per-IP journey counts (m) and abandoned journey counts (y)
+    and their squares and products over the IP addresses.
+    Totals of sets of journeys with disjoint IP addresses can be added up.
+    Returns None without IP addresses.
+    """
+
+    if 'ip' not in journeys.columns:
+        return None
+    clusters = journeys.groupby('ip', sort=False)['abandoned'].agg(['sum', 'size'])
+    y = clusters['sum'].to_numpy(dtype=float)
+    m = clusters['size'].to_numpy(dtype=float)
+    return pd.Series({'n_ip': len(m), 'm': m.sum(), 'y': y.sum(),
+                      'm2': (m ** 2).sum(), 'y2': (y ** 2).sum(),
+                      'ym': (y * m).sum()})
+
+
+def design_effect(ip_totals: Optional[pd.Series]) -> float:
+    """Estimates the design effect of the abandonment rate
+    when IP addresses (the sampling unit) are sampled as a whole.
+
+    The variance of the ratio estimator over the per-IP counts is compared
+    to the variance of independently sampled journeys. If it cannot be
+    estimated (rate of 0 or 1, single IP), the upper bound
+    (mean IP size weighted by journeys) is used.
+    Without IP addresses the journeys are the sampling unit.
+    """
+
+    if ip_totals is None or ip_totals['m'] == 0:
+        return 1.
+    n_ip = ip_totals['n_ip']
+    n = ip_totals['m']
+    p = ip_totals['y'] / n
+    if n_ip < 2 or p in (0., 1.):
+        return float(ip_totals['m2'] / n)
+
+    # sum of (y - p * m) ** 2 over the IP addresses
+    ss = ip_totals['y2'] - 2 * p * ip_totals['ym'] + p ** 2 * ip_totals['m2']
+    var_ratio = n_ip / (n_ip - 1) * max(ss, 0.) / n ** 2
+    return max(1., var_ratio / (p * (1 - p) / n))
+
+
+def scale_sample(stats_global: pd.DataFrame, edges: pd.DataFrame,
+                 sample_rate: float,
+                 ip_totals: Optional[pd.Series] = None,
+                 confidence: float = 0.95) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Scales the counts of a journey sample up to the full data set
+    and adds confidence intervals of the abandonment and conversion rates.
+
+    The intervals are Wilson score intervals on the effective sample size,
+    i.e. the number of journeys divided by the design effect of sampling
+    whole IP addresses and the finite population correction.
+    """
+
+    d = stats_global['value'].copy()
+    n = d['visitors']
+    p = d['browse_abandonment_pct']
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    if n > 0:
+        # 1 / effective sample size
+        k = design_effect(ip_totals) * (1 - sample_rate) / n
+        denom = 1 + z ** 2 * k
+        center = (p + z ** 2 * k / 2) / denom
+        half = z * (p * (1 - p) * k + z ** 2 * k ** 2 / 4) ** 0.5 / denom
+    else:
+        center = half = float('nan')
+
+    for name in ['visitors', 'browse_abandonment_n',
+                 'cart_conversion_n', 'sales_conversion_n']:
+        d[name] = d[name] / sample_rate
+
+    d['sample_rate'] = sample_rate
+    d['sample_visitors'] = n
+    d['browse_abandonment_pct_ci_low'] = max(0., center - half)
+    d['browse_abandonment_pct_ci_high'] = min(1., center + half)
+    d['cart_conversion_pct_ci_low'] = max(0., 1 - center - half)
+    d['cart_conversion_pct_ci_high'] = min(1., 1 - center + half)
+
+    edges['freq'] = edges['freq'] / sample_rate
+
+    return d.to_frame(), edges
+
+
+def summarize(journeys: pd.DataFrame,
+              edges: pd.DataFrame,
+              sample_rate: Optional[float] = None,
+              sketches: Optional[SketchTable] = None
+              ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Calculates global stats from the journeys
+    and adds the total number of visitors to the weighted edges,
+    and the distinct visitors if sketches are given.
+    Counts are scaled up if the journeys are a sample.
+    """
+
+    ip_totals = get_ip_totals(journeys) if sample_rate is not None else None
+    return summarize_totals(get_journey_totals(journeys), edges,
+                            sample_rate, sketches, ip_totals)
+
+
+def summarize_totals(totals: pd.DataFrame,
+                     edges: pd.DataFrame,
+                     sample_rate: Optional[float] = None,
+                     sketches: Optional[SketchTable] = None,
+                     ip_totals: Optional[pd.Series] = None
+                     ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Same as `summarize`, from the journey totals
+    (and the IP totals for the confidence intervals of a sample).
+    """
+
+    stats_global = get_global_stats_from_totals(totals)
+    if sketches is not None:
+        edges = add_unique_visitors(edges, sketches)
+    if sample_rate is not None:
+        stats_global, edges = scale_sample(stats_global, edges, sample_rate,
+                                           ip_totals)
     edges['total_visitors'] = stats_global.loc['visitors', 'value']
     stats_global = stats_global.reset_index()
 
+    return stats_global, edges
+
+
+def analyze(store: JourneyStore,
+            sample_rate: Optional[float] = None,
+            sketch_precision: Optional[int] = None
+            ) -> Tuple[pd.DataFrame, pd.DataFrame, Optional[SketchTable]]:
+    """Calculates global stats and weighted edges,
+    and distinct visitor sketches per edge if precision is given.
+    """
+
+    sketches = None
+    if sketch_precision is not None:
+        sketches = get_edge_sketches(store, sketch_precision, sample_rate)
+    stats_global, edges = summarize(get_journeys(store),
+                                    get_weighted_edges(store),
+                                    sample_rate, sketches)
+
     # TODO: prediction
 
     logger.info('Analysis completed successfully.')
 
-    return stats_global, edges
+    return stats_global, edges, sketches
 
 
 def main():
@@ -86,7 +360,9 @@ def main():
                         help='output stats csv file')
     parser.add_argument('output_file_edges', action='store',
                         help='output edges csv file')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    profiler = get_profiler(args, [get_journeys, get_weighted_edges])
 
     input_file = Path(args.input_file)
     output_file_stats = Path(args.output_file_stats)
@@ -95,7 +371,9 @@ def main():
     content = pd.read_csv(input_file)
     logger.debug(f'Reading from: {input_file.absolute()}')
 
-    stats_global, edges = analyze(content)
+    with profiler.stage('analyze'):
+        store = get_edges(JourneyStore.from_frame(content))
+        stats_global, edges, __ = analyze(store)
 
     stats_global.to_csv(output_file_stats, index=False)
     edges.to_csv(output_file_edges, index=False)
@@ -1,13 +1,23 @@
 import argparse
+import asyncio
+import hashlib
+import http.client
 import logging
+import re
+import threading
+from collections import defaultdict
 from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+from urllib.parse import urljoin, urlsplit
 from urllib.request import urlopen
-from urllib.error import URLError
+from urllib.error import HTTPError, URLError
 from zipfile import ZipFile, ZIP_DEFLATED
 
 
 logger = logging.getLogger(Path(__file__).stem)
 
+LOG_URL = 'https://exsightech.com/l/log.txt'
+
 
 def get_log(url: str) -> bytes:
     """Gets most recent log file content from the web.
@@ -37,7 +47,7 @@ def collect() -> bytes:
     Downloads data from url.
     """
 
-    url = 'https://exsightech.com/l/log.txt'
+    url = LOG_URL
     content = get_log(url)
 
     msg = ['Data collection completed successfully.']
@@ -52,14 +62,229 @@ def collect() -> bytes:
     return content
 
 
+class _ConnectionPool:
+    """Keeps idle keep-alive HTTP connections per (scheme, host)
+    so that repeated requests to the same site reuse the socket.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        with self._lock:
+            idle = self._idle[(scheme, netloc)]
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, scheme: str, netloc: str,
+                conn: http.client.HTTPConnection, reusable: bool):
+        if reusable:
+            with self._lock:
+                self._idle[(scheme, netloc)].append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+
+def _zip_name(url: str) -> str:
+    """Derives a file system safe zip file name from the source url.
+    A short hash of the full url keeps the names of urls
+    differing only in scheme, query or special characters apart.
+    """
+
+    parts = urlsplit(url)
+    path = parts.path.rsplit('.', 1)[0] if parts.path.endswith('.txt') else parts.path
+    name = re.sub(r'[^\w.-]+', '_', parts.netloc + path).strip('_')
+    digest = hashlib.sha1(url.encode('utf8')).hexdigest()[:8]
+    return f'{name}_{digest}.zip'
+
+
+def _stream_to_zip(pool: _ConnectionPool, url: str, zip_path: Path,
+                   chunk_size: int = 1 << 16,
+                   max_redirects: int = 5) -> Tuple[int, bytes]:
+    """Downloads the url into the `log.txt` member of a zip file
+    without holding the whole content in memory (blocking).
+
+    Returns the number of lines and the last line of the content.
+    """
+
+    for __ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        conn = pool.acquire(parts.scheme, parts.netloc)
+        reusable = False
+        try:
+            conn.request('GET', target)
+            resp = conn.getresponse()
+            if resp.status in (301, 302, 303, 307, 308):
+                resp.read()
+                reusable = not resp.will_close
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+            if resp.status != 200:
+                resp.read()
+                reusable = not resp.will_close
+                raise HTTPError(url, resp.status, resp.reason, resp.headers, None)
+
+            n_lines = 0
+            tail = b''
+            tmp_path = zip_path.with_name(zip_path.name + '.part')
+            try:
+                with ZipFile(tmp_path, 'w', compression=ZIP_DEFLATED) as zf:
+                    with zf.open('log.txt', 'w', force_zip64=True) as f:
+                        while chunk := resp.read(chunk_size):
+                            f.write(chunk)
+                            n_lines += chunk.count(b'\n')
+                            tail = (tail + chunk)[-chunk_size:]
+                tmp_path.replace(zip_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            reusable = not resp.will_close
+            lines = tail.splitlines()
+            return n_lines, (lines[-1] if lines else b'')
+        finally:
+            pool.release(parts.scheme, parts.netloc, conn, reusable)
+
+    raise HTTPError(url, 310, 'Too many redirects', None, None)
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, (OSError, http.client.HTTPException))
+
+
+async def _collect_source(pool: _ConnectionPool, semaphore: asyncio.Semaphore,
+                          url: str, zip_path: Path,
+                          retries: int, backoff: float) -> Path:
+    """Downloads one source with retries and exponential backoff.
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                n_lines, last_line = await asyncio.to_thread(
+                    _stream_to_zip, pool, url, zip_path)
+            break
+        except Exception as e:
+            if attempt == retries or not _is_retryable(e):
+                logger.error('Could not fetch log file from {} '
+                             'after {} attempt(s) ({})'.format(url, attempt + 1, e))
+                raise
+            delay = backoff * 2 ** attempt
+            logger.warning('Fetching {} failed ({}), retrying in {:.1f}s'
+                           .format(url, e, delay))
+            await asyncio.sleep(delay)
+
+    last_line = last_line.decode('utf8', errors='replace')
+    msg = ['Data collection completed successfully.']
+    msg += [
+        '\t> source: {}'.format(url),
+        '\t> number of lines: {}'.format(n_lines),
+        '\t> last date: {}'.format(' '.join(last_line.split(' ')[0:2])),
+        '\t> written to: {}'.format(zip_path.absolute()),
+    ]
+    logger.info('\n'.join(msg))
+
+    return zip_path
+
+
+async def collect_many_async(urls: Iterable[str], output_dir: Path,
+                             max_concurrency: int = 4,
+                             timeout: float = 30.,
+                             retries: int = 3,
+                             backoff: float = 1.) -> Dict[str, Path]:
+    """Downloads several log sources concurrently,
+    each into its own zip file (same layout as `save_to_file`)
+    in the output directory.
+
+    Returns the url -> zip path mapping of successful downloads;
+    raises the first error after all sources have been attempted.
+    """
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    urls = list(dict.fromkeys(urls))
+
+    pool = _ConnectionPool(timeout)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    try:
+        results = await asyncio.gather(
+            *[_collect_source(pool, semaphore, url, output_dir / _zip_name(url),
+                              retries, backoff)
+              for url in urls],
+            return_exceptions=True)
+    finally:
+        pool.close()
+
+    paths = {u: r for (u, r) in zip(urls, results)
+             if not isinstance(r, BaseException)}
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        logger.error('{} of {} source(s) failed.'.format(len(errors), len(urls)))
+        raise errors[0]
+
+    return paths
+
+
+def collect_many(urls: Iterable[str], output_dir: Path, **kwargs) -> Dict[str, Path]:
+    """Synchronous wrapper of `collect_many_async`.
+    """
+
+    return asyncio.run(collect_many_async(urls, output_dir, **kwargs))
+
+
+def read_sources(path: Path) -> List[str]:
+    """Reads source urls from a text file (one per line, # for comments).
+    """
+
+    with open(path) as f:
+        lines = [line.split('#', 1)[0].strip() for line in f]
+    return [line for line in lines if line]
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
     parser.add_argument('output_file', action='store',
-                        help='target zip path')
+                        help='target zip path '
+                             '(output directory when sources are given)')
+    parser.add_argument('--source', action='append', default=[],
+                        help='log source url (can be repeated)')
+    parser.add_argument('--sources-file', action='store', type=str,
+                        help='text file with log source urls, one per line')
+    parser.add_argument('--concurrency', action='store', type=int, default=4,
+                        help='maximum number of parallel downloads')
+    parser.add_argument('--timeout', action='store', type=float, default=30.,
+                        help='socket timeout in seconds')
+    parser.add_argument('--retries', action='store', type=int, default=3,
+                        help='number of retries per source')
     args = parser.parse_args()
 
+    urls = list(args.source)
+    if args.sources_file is not None:
+        urls += read_sources(Path(args.sources_file))
+    if urls:
+        collect_many(urls, Path(args.output_file),
+                     max_concurrency=args.concurrency,
+                     timeout=args.timeout,
+                     retries=args.retries)
+        return
+
     content = collect()
 
     output_file = Path(args.output_file)
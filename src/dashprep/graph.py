@@ -1,9 +1,16 @@
 import argparse
+import json
 import logging
+from dataclasses import dataclass, replace
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+from dashprep.profiling import add_profile_arguments, get_profiler
+from dashprep.sketch import hash_values
+
 
 logger = logging.getLogger(Path(__file__).stem)
 
@@ -23,154 +30,503 @@ PHASE_ORDER = [
 PHASE_LEVEL_MAP = {name: i for (i, name) in enumerate(PHASE_ORDER)}
 
 
-def identify_journeys(df: pd.DataFrame,
-                      timeout_threshold: str = '2:00:00') -> pd.DataFrame:
-    """Identify journeys by cart events and timeout.
+@dataclass(frozen=True)
+class SessionRules:
+    """Sessionization settings.
+
+    Events with the same key columns form a journey,
+    which ends after a terminator event or when the time between
+    two events exceeds the timeout. Events are compressed to phases
+    in the phase order, which has to end with STOP.
+    Journeys ending with a terminator phase are conversions.
+    Nodes of events in `node_name_columns` (event, column pairs)
+    are named by the column; other events without a built-in name column
+    are named by the event.
     """
 
-    timeout_threshold = pd.to_timedelta(timeout_threshold)
+    name: str = 'default'
+    key_columns: Tuple[str, ...] = ('ip', 'cid', 'device', 'url_subdomain')
+    timeout: str = '2:00:00'
+    terminator_events: Tuple[str, ...] = (PHASE_CART_NM,)
+    phase_order: Tuple[str, ...] = tuple(PHASE_ORDER)
+    node_name_columns: Tuple[Tuple[str, str], ...] = ()
 
-    journey_id_columns = ['ip', 'cid', 'device', 'url_subdomain']
-    df['_jid_base'] = (
-        df[journey_id_columns].apply('_'.join, axis=1)
-        .astype('category').cat.codes.astype(str)
-    )
+    def __post_init__(self):
+        if not self.phase_order or self.phase_order[-1] != PHASE_STOP_NM:
+            raise ValueError(f'Phase order of session rules "{self.name}" '
+                             f'has to end with {PHASE_STOP_NM}.')
+        unknown = [e for e in self.terminator_events
+                   if e not in self.phase_order]
+        if unknown:
+            raise ValueError(f'Terminator events of session rules "{self.name}" '
+                             f'are not in the phase order: {unknown}')
 
-    df = df.sort_values('timestamp', ignore_index=True)
-
-    # cart event before -> new journey
-    df['_flg_cart'] = (df['event'] == PHASE_CART_NM).astype(int)
-    df['_flg_cart_before'] = (df
-                              .groupby('_jid_base')['_flg_cart']
-                              .shift().fillna(0).astype(int))
-
-    # too much time elapsed -> new journey
-    df['_diff_time'] = df.groupby('_jid_base')['timestamp'].diff()
-    df['_flg_timeout_before'] = ((df['_diff_time'] > timeout_threshold)
-                                 .astype(int))
-
-    # compose journey id
-    df['_flg_journey_start'] = (df['_flg_cart_before']
-                                | df['_flg_timeout_before'])
-    df['_jid_sub'] = (df.groupby('_jid_base')['_flg_journey_start']
-                      .cumsum().astype(str))
-    df['journey_id'] = (df['_jid_base'] + '_' + df['_jid_sub'])
-
-    # correct time between steps in journey and sum
-    df['_diff_time'] = df.groupby('journey_id')[
-        'timestamp'].diff().dt.total_seconds().fillna(0)
-    # print(df.groupby('journey_id')['_diff_time'].sum())
-    df['total_time'] = df.groupby('journey_id')['_diff_time'].transform('sum')
-    df['total_steps'] = df.groupby('journey_id')[
-        'timestamp'].transform('count')
-
-    # calculate cart event
-    df['flg_cart_event'] = (
-        df.groupby('journey_id')['_flg_cart'].transform('max'))
-
-    # cleanup
-    df = df.drop(
-        [c for c in df.columns if c.startswith('x_') or c.startswith('_')],
-        axis=1)
+    @classmethod
+    def from_dict(cls, d: dict) -> 'SessionRules':
+        def _freeze(v):
+            if isinstance(v, dict):
+                return tuple(v.items())
+            return tuple(v) if isinstance(v, list) else v
 
-    return df
+        return cls(**{k: _freeze(v) for (k, v) in d.items()})
+
+    @property
+    def phase_level_map(self) -> Dict[str, int]:
+        return {name: i for (i, name) in enumerate(self.phase_order)}
+
+    @property
+    def terminator_levels(self) -> List[int]:
+        return [self.phase_order.index(e) for e in self.terminator_events]
+
+
+DEFAULT_RULES = SessionRules()
+
+
+def read_session_rules(path: Path) -> List[SessionRules]:
+    """Reads a list of session rule definitions from a json file.
+    Names have to be unique, they identify the outputs.
+    """
+
+    with open(path) as f:
+        rules = [SessionRules.from_dict(d) for d in json.load(f)]
+    names = [r.name for r in rules]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError(f'Duplicate session rule names: {duplicates}')
+    return rules
+
+
+class SessionEngine:
+    """Sessionizes an event frame with several rule sets.
+
+    Events are sorted by time once, and the grouping by key columns
+    is shared by the rule sets with the same keys,
+    so every additional rule set only costs a few vectorized passes
+    over the sorted arrays.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df.sort_values('timestamp', kind='stable', ignore_index=True)
+        self._ts = (self.df['timestamp'].to_numpy(dtype='datetime64[ns]')
+                    .view(np.int64))
+        self._event = self.df['event'].to_numpy(dtype=object)
+        self._keys = dict()
+
+    def _key_groups(self, key_columns: Tuple[str, ...]
+                    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the key code of the events, the order
+        which groups the events by key (in time order within keys)
+        and the stable hash of each key (visitor).
+        """
+
+        if key_columns not in self._keys:
+            keys = self.df[key_columns[0]].astype(str)
+            for col in key_columns[1:]:
+                keys = keys + '_' + self.df[col].astype(str)
+            codes, uniques = pd.factorize(keys, sort=True)
+            self._keys[key_columns] = (codes, np.argsort(codes, kind='stable'),
+                                       hash_values(uniques))
+        return self._keys[key_columns]
+
+    def identify_journeys(self, rules: SessionRules = DEFAULT_RULES
+                          ) -> pd.DataFrame:
+        """Identify journeys by terminator events and timeout.
+        """
+
+        codes, order, key_hash = self._key_groups(rules.key_columns)
+        key = codes[order]
+        ts = self._ts[order]
+        timeout = pd.to_timedelta(rules.timeout).value
+
+        # terminator event before or too much time elapsed -> new journey
+        is_term = np.isin(self._event, list(rules.terminator_events))[order]
+        same_key = np.r_[False, key[1:] == key[:-1]]
+        new_sub = same_key & (np.r_[False, is_term[:-1]]
+                              | (np.diff(ts, prepend=ts[:1]) > timeout))
+        key_start = np.flatnonzero(~same_key)
+        n_sub = np.cumsum(new_sub)
+        sub = n_sub - np.repeat(n_sub[key_start], np.diff(np.r_[key_start, len(key)]))
+
+        # journey level aggregates
+        starts = np.flatnonzero(~same_key | new_sub)
+        lengths = np.diff(np.r_[starts, len(key)])
+        ends = starts + lengths - 1
+
+        journey_id = (pd.Series(key[starts]).astype(str) + '_'
+                      + pd.Series(sub[starts]).astype(str)).to_numpy()
+
+        values = {
+            'journey_id': journey_id,
+            'total_time': (ts[ends] - ts[starts]) / 1e9,
+            'total_steps': lengths,
+            'flg_cart_event': np.maximum.reduceat(is_term, starts).astype(int),
+            'visitor_hash': key_hash[key[starts]],
+        }
+        inverse = np.empty(len(order), dtype=np.int64)
+        inverse[order] = np.repeat(np.arange(len(starts)), lengths)
+
+        df = self.df.drop([c for c in self.df.columns if c.startswith('x_')],
+                          axis=1)
+        for col, v in values.items():
+            df[col] = v[inverse]
+        return df
+
+    def build_graph(self, rules: SessionRules = DEFAULT_RULES
+                    ) -> 'JourneyStore':
+        df = self.identify_journeys(rules)
+        df = identify_phases(df, rules=rules)
+        store = compress_to_phases(df, rules=rules)
+        store = get_edges(store)
+        return store
+
+    def run(self, rules: List[SessionRules]) -> Dict[str, 'JourneyStore']:
+        """Builds the graph for every rule set.
+        """
+
+        stores = dict()
+        for r in rules:
+            stores[r.name] = self.build_graph(r)
+            logger.info(f'Graph was created for session rules "{r.name}".')
+        return stores
+
+
+def identify_journeys(df: pd.DataFrame,
+                      rules: SessionRules = DEFAULT_RULES) -> pd.DataFrame:
+    """Identify journeys by cart events and timeout.
+    """
+
+    return SessionEngine(df).identify_journeys(rules)
 
 
 def identify_phases(df: pd.DataFrame,
-                    drop_unknown: bool = True) -> pd.DataFrame:
+                    drop_unknown: bool = True,
+                    rules: SessionRules = DEFAULT_RULES) -> pd.DataFrame:
     """Adds phase level number using event name
     and drops unknown events if required.
     """
 
-    df['phase_level'] = df['event'].apply(PHASE_LEVEL_MAP.get)
+    df['phase_level'] = df['event'].map(rules.phase_level_map)
     if drop_unknown:
         df = df[df['phase_level'].notna()]
 
     return df
 
 
-def compress_to_phases(df: pd.DataFrame) -> pd.DataFrame:
-    """Compresses event series to phase series.
+class StringTable:
+    """Interned string table; strings are referred to by int32 ids,
+    missing values by -1.
     """
 
-    phase_lvl_cart = PHASE_ORDER.index(PHASE_CART_NM)
-    phase_lvl_stop = PHASE_ORDER.index(PHASE_STOP_NM)
+    def __init__(self):
+        self.values = []
+        self._ids = dict()
 
-    def _generate_stop_event(r: pd.Series) -> pd.Series:
-        """Generates STOP event as a pandas Series.
+    def intern(self, values) -> np.ndarray:
+        """Returns the ids of the values, adding new strings to the table.
         """
 
-        stop_event = r.copy()
-        stop_event['event'] = PHASE_STOP_NM
-        stop_event['phase_level'] = phase_lvl_stop
-
-        del stop_event['category']
-        del stop_event['url']
-        del stop_event['referrer']
-        del stop_event['price']
-        del stop_event['quantity']
-        return stop_event
-
-    records = []
-    for __, _df in df.groupby('journey_id'):
-        phases = [None, None, None, None, None]
-        prev_phase_lvl = -1
-        for i, r in _df.iterrows():
-            phase_lvl = int(r['phase_level'])
-            if prev_phase_lvl < phase_lvl:
-                phases[phase_lvl] = r
-                if phase_lvl == phase_lvl_cart:
-                    break
-            else:
-                phases[phase_lvl] = r
-                for i in range(phase_lvl + 1, len(phases)):
-                    phases[i] = None
-            prev_phase_lvl = phase_lvl
-        phases[phase_lvl_stop] = _generate_stop_event(r)
-
-        records += [p for p in phases if p is not None]
-    df = pd.DataFrame.from_records(records)
-    return df
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        mapping = np.empty(len(uniques) + 1, dtype=np.int32)
+        mapping[-1] = -1
+        for i, v in enumerate(uniques):
+            v = str(v)
+            if v not in self._ids:
+                self._ids[v] = len(self.values)
+                self.values.append(v)
+            mapping[i] = self._ids[v]
+        return mapping[codes]
+
+    def decode(self, ids: np.ndarray) -> np.ndarray:
+        """Returns the strings of the ids (None for missing).
+        """
 
+        table = np.array(self.values + [None], dtype=object)
+        return table[ids]
 
-def get_edges(df: pd.DataFrame) -> pd.DataFrame:
-
-    def _get_node_name(row: pd.Series) -> str:
-        if row['event'] == PHASE_INDEX_NM:
-            return row['url']
-        elif row['event'] == PHASE_PRODUCT_NM:
-            return row['name']
-        elif row['event'] == PHASE_CATEGORY_NM:
-            return row['category']
-        elif row['event'] == PHASE_CART_NM:
-            return 'CART'
-        elif row['event'] == PHASE_STOP_NM:
-            return 'STOP'
-        else:
-            return None
-
-    df = df.loc[:,
-                ['journey_id', 'url_subdomain', 'event', 'phase_level', 'device', 'source_type', 'url', 'name', 'category',
-                 'total_time', 'total_steps']].copy()
-    df['to_node'] = df.apply(_get_node_name, axis=1)
-    df['to_node_type'] = df['event']
-    df['from_node'] = df.groupby('journey_id')[
-        'to_node'].shift().fillna('START')
-    df['from_node_type'] = df.groupby('journey_id')[
-        'to_node_type'].shift().fillna('START')
 
-    return df
+class NodeDictionary:
+    """Maps (node type, node name) pairs to int32 node ids.
+    Node types are phase levels (-1: START),
+    node names are ids of the string table (-1: missing).
+    """
 
+    def __init__(self, strings: StringTable,
+                 phase_order: Tuple[str, ...] = tuple(PHASE_ORDER)):
+        self.strings = strings
+        self.phase_order = phase_order
+        self.phase = np.empty(0, dtype=np.int8)
+        self.name = np.empty(0, dtype=np.int32)
+        self._ids = dict()
 
-def build_graph(df: pd.DataFrame) -> pd.DataFrame:
-    df = identify_journeys(df)
-    df = identify_phases(df)
-    df = compress_to_phases(df)
-    df = get_edges(df)
+    def __len__(self) -> int:
+        return len(self.phase)
+
+    def encode(self, phase: np.ndarray, name: np.ndarray) -> np.ndarray:
+        """Returns the node ids of the pairs, adding new nodes.
+        """
+
+        phase = np.asarray(phase, dtype=np.int64)
+        name = np.asarray(name, dtype=np.int64)
+        codes, uniques = pd.factorize((phase << 32) | (name & 0xFFFFFFFF))
+
+        mapping = np.empty(len(uniques), dtype=np.int32)
+        new = []
+        for i, key in enumerate(uniques.tolist()):
+            if key not in self._ids:
+                self._ids[key] = len(self._ids)
+                new.append(key)
+            mapping[i] = self._ids[key]
+        if new:
+            new = np.array(new, dtype=np.int64)
+            self.phase = np.r_[self.phase, (new >> 32).astype(np.int8)]
+            self.name = np.r_[self.name, new.astype(np.int32)]
+        return mapping[codes]
+
+    def encode_names(self, phase: np.ndarray, names) -> np.ndarray:
+        """Returns the node ids of the node types and name strings.
+        """
+
+        return self.encode(phase, self.strings.intern(names))
+
+    def types(self, ids: np.ndarray) -> np.ndarray:
+        """Returns the node type names of the node ids.
+        """
+
+        phase_names = np.array(list(self.phase_order) + ['START'], dtype=object)
+        return phase_names[self.phase[ids]]
+
+    def names(self, ids: np.ndarray, missing: Optional[str] = None) -> np.ndarray:
+        """Returns the node names of the node ids.
+        """
+
+        names = self.strings.decode(self.name[ids])
+        if missing is not None:
+            names[self.name[ids] == -1] = missing
+        return names
+
+
+@dataclass
+class JourneyStore:
+    """Compact struct-of-arrays representation of phase series.
+
+    Events of journey `j` are `offsets[j]:offsets[j + 1]`,
+    the last event of every journey is STOP.
+    Strings (journey ids, source types, etc.) are int32 ids
+    into the interned string table,
+    nodes are int32 ids into the node dictionary.
+    """
+
+    rules: SessionRules
+    strings: StringTable
+    nodes: NodeDictionary
+    offsets: np.ndarray
+    # journey level
+    journey_id: np.ndarray
+    url_subdomain: np.ndarray
+    device: np.ndarray
+    total_time: np.ndarray
+    total_steps: np.ndarray
+    # event level
+    node: np.ndarray
+    source_type: np.ndarray
+    # edges (filled by `get_edges`)
+    from_node: Optional[np.ndarray] = None
+    # stable visitor (journey key) hash of the journeys, if known
+    visitor: Optional[np.ndarray] = None
+    # IP address (sampling unit) of the journeys, if known
+    ip: Optional[np.ndarray] = None
+
+    @property
+    def n_journeys(self) -> int:
+        return len(self.offsets) - 1
+
+    def event_journey(self) -> np.ndarray:
+        """Returns the journey index of each event.
+        """
+
+        return np.repeat(np.arange(self.n_journeys), np.diff(self.offsets))
+
+    def to_frame(self) -> pd.DataFrame:
+        """Decodes the store to one row per event (edge).
+        """
+
+        jix = self.event_journey()
+        df = pd.DataFrame({
+            'journey_id': self.strings.decode(self.journey_id[jix]),
+            'url_subdomain': self.strings.decode(self.url_subdomain[jix]),
+            'event': self.nodes.types(self.node),
+            'phase_level': self.nodes.phase[self.node].astype(int),
+            'device': self.strings.decode(self.device[jix]),
+            'source_type': self.strings.decode(self.source_type),
+            'total_time': self.total_time[jix],
+            'total_steps': self.total_steps[jix],
+            'to_node': self.nodes.names(self.node),
+            'to_node_type': self.nodes.types(self.node),
+        })
+        if self.from_node is not None:
+            df['from_node'] = self.nodes.names(self.from_node, missing='START')
+            df['from_node_type'] = self.nodes.types(self.from_node)
+        return df
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame,
+                   rules: SessionRules = DEFAULT_RULES) -> 'JourneyStore':
+        """Builds the store from the rows of `to_frame` (e.g. graph csv).
+        Rows of a journey have to be in phase order.
+        """
+
+        jid, __ = pd.factorize(df['journey_id'])
+        order = np.argsort(jid, kind='stable')
+        df = df.iloc[order]
+        jid = jid[order]
+        starts = np.flatnonzero(np.r_[True, jid[1:] != jid[:-1]])
+        first = df.iloc[starts]
+
+        strings = StringTable()
+        nodes = NodeDictionary(strings, rules.phase_order)
+        phase = (df['to_node_type'].map(rules.phase_level_map)
+                 .to_numpy(dtype=np.int8))
+        return cls(
+            rules=rules,
+            strings=strings,
+            nodes=nodes,
+            offsets=np.r_[starts, len(df)].astype(np.int64),
+            journey_id=strings.intern(first['journey_id']),
+            url_subdomain=strings.intern(first['url_subdomain']),
+            device=strings.intern(first['device']),
+            total_time=first['total_time'].to_numpy(dtype=float),
+            total_steps=first['total_steps'].to_numpy(dtype=np.int64),
+            node=nodes.encode_names(phase, df['to_node']),
+            source_type=strings.intern(df['source_type']),
+        )
+
+
+def _select_node_names(df: pd.DataFrame,
+                       rules: SessionRules = DEFAULT_RULES) -> np.ndarray:
+    """Selects the node name of the events based on the event type
+    (the event name for events without name column).
+    """
+
+    def _column(col: str) -> np.ndarray:
+        if col not in df.columns:
+            return np.full(len(df), None, dtype=object)
+        return df[col].to_numpy(dtype=object)
+
+    event = df['event'].to_numpy(dtype=object)
+    custom = [(e, col) for (e, col) in rules.node_name_columns
+              if col in df.columns]
+    return np.select(
+        [event == e for (e, __) in custom] +
+        [event == PHASE_INDEX_NM,
+         event == PHASE_PRODUCT_NM,
+         event == PHASE_CATEGORY_NM,
+         event == PHASE_CART_NM,
+         event == PHASE_STOP_NM],
+        [_column(col) for (__, col) in custom] +
+        [_column('url'),
+         _column('name'),
+         _column('category'),
+         'CART',
+         'STOP'],
+        default=event)
+
+
+def compress_to_phases(df: pd.DataFrame,
+                       rules: SessionRules = DEFAULT_RULES) -> JourneyStore:
+    """Compresses event series to phase series.
+
+    Events after the first terminator event of a journey are ignored,
+    and an event is kept only if every later event of the journey
+    has a higher phase level (going back to a phase discards the
+    phases reached since). A STOP event closes every journey.
+    """
+
+    phase_lvl_stop = rules.phase_order.index(PHASE_STOP_NM)
+    phase_lvl_inf = len(rules.phase_order)
+
+    # journeys in id order, events in time order
+    df = df.sort_values('journey_id', kind='stable')
+    jid, jid_uniques = pd.factorize(df['journey_id'], sort=True)
+    level = df['phase_level'].to_numpy(dtype=np.int8)
+    starts = np.flatnonzero(np.r_[len(jid) > 0, jid[1:] != jid[:-1]])
+    lengths = np.diff(np.r_[starts, len(df)])
+
+    # drop events after the first terminator event
+    is_term = np.isin(level, rules.terminator_levels).astype(np.int64)
+    terms_before = np.cumsum(is_term) - is_term
+    terms_before -= np.repeat(terms_before[starts], lengths)
+    active = terms_before == 0
+
+    # keep events below the minimum level of the later events
+    masked = np.where(active, level, phase_lvl_inf).astype(np.int8)
+    suffix_min = (pd.Series(masked[::-1])
+                  .groupby(jid[::-1]).cummin()
+                  .to_numpy()[::-1])
+    next_min = np.r_[suffix_min[1:], phase_lvl_inf].astype(np.int8)
+    next_min[starts[1:] - 1] = phase_lvl_inf
+    kept = np.flatnonzero(active & (level < next_min))
+
+    # STOP events inherit the attributes of the last kept event
+    n_journeys = len(starts)
+    counts = np.bincount(jid[kept], minlength=n_journeys) + 1
+    offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+    last_kept = kept[offsets[1:] - np.arange(1, n_journeys + 1) - 1]
+    stop_pos = offsets[1:] - 1
+    event_pos = np.delete(np.arange(offsets[-1]), stop_pos)
+
+    strings = StringTable()
+    nodes = NodeDictionary(strings, rules.phase_order)
+    source_ids = strings.intern(df['source_type'])
+    stop_id = nodes.encode_names([phase_lvl_stop], [PHASE_STOP_NM])[0]
+
+    node = np.empty(offsets[-1], dtype=np.int32)
+    node[event_pos] = nodes.encode_names(
+        level[kept], _select_node_names(df.iloc[kept], rules))
+    node[stop_pos] = stop_id
+    source_type = np.empty(offsets[-1], dtype=np.int32)
+    source_type[event_pos] = source_ids[kept]
+    source_type[stop_pos] = source_ids[last_kept]
+
+    first = df.iloc[starts]
+    return JourneyStore(
+        rules=rules,
+        strings=strings,
+        nodes=nodes,
+        offsets=offsets,
+        journey_id=strings.intern(jid_uniques),
+        url_subdomain=strings.intern(first['url_subdomain']),
+        device=strings.intern(first['device']),
+        total_time=first['total_time'].to_numpy(dtype=float),
+        total_steps=first['total_steps'].to_numpy(dtype=np.int64),
+        node=node,
+        source_type=source_type,
+        visitor=(first['visitor_hash'].to_numpy(dtype=np.uint64)
+                 if 'visitor_hash' in first.columns else None),
+        ip=(strings.intern(first['ip']) if 'ip' in first.columns else None),
+    )
+
+
+def get_edges(store: JourneyStore) -> JourneyStore:
+    """Adds the source node of each event, so that
+    (`from_node`, `node`) are the edges as node id pairs.
+    The first event of the journeys comes from the START node.
+    """
+
+    start_id = store.nodes.encode_names([-1], ['START'])[0]
+
+    from_node = np.r_[start_id, store.node[:-1]].astype(np.int32)
+    from_node[store.offsets[:-1]] = start_id
+
+    return replace(store, from_node=from_node)
+
+
+def build_graph(df: pd.DataFrame,
+                rules: SessionRules = DEFAULT_RULES) -> JourneyStore:
+    store = SessionEngine(df).build_graph(rules)
 
     logger.info(f'Graph was created successfully.')
 
-    return df
+    return store
 
 
 def main():
@@ -179,17 +535,21 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('input_file', help='input csv file')
     parser.add_argument('output_file', help='output csv file')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    profiler = get_profiler(args, [SessionEngine.identify_journeys,
+                                   compress_to_phases, get_edges])
 
     input_file = Path(args.input_file)
     logger.debug(f'Reading from: {input_file.absolute()}')
     df = pd.read_csv(input_file, dtype=str)
     df['timestamp'] = pd.to_datetime(df['timestamp'])
 
-    df = build_graph(df)
+    with profiler.stage('build_graph'):
+        store = build_graph(df)
 
     output_file = Path(args.output_file)
-    df.to_csv(output_file, index=False)
+    store.to_frame().to_csv(output_file, index=False)
     logger.info(f'Data written to: {output_file.absolute()}')
 
 
@@ -1,50 +1,200 @@
 import argparse
 import logging
+import sys
+import tempfile
+from contextlib import ExitStack
 from pathlib import Path
+from typing import Optional
 
-from dashprep.analyze import analyze
-from dashprep.collect import collect
-from dashprep.graph import build_graph
-from dashprep.prepare import prepare
+import pandas as pd
+
+from dashprep.analyze import analyze, get_journeys, get_weighted_edges
+from dashprep.collect import LOG_URL, collect, collect_many
+from dashprep.graph import (SessionEngine, build_graph, compress_to_phases,
+                            get_edges, read_session_rules)
+from dashprep.outofcore import analyze_out_of_core, iter_chunks, open_log
+from dashprep.prepare import convert_to_df, find_parts, prepare, process_parts
+from dashprep.profiling import add_profile_arguments, get_profiler
+from dashprep.sketch import DEFAULT_PRECISION, SketchTable, sketch_path
+from dashprep.shard import (PARTITION_BY_HASH, PARTITION_BY_SUBDOMAIN,
+                            analyze_sharded)
 
 
 logger = logging.getLogger(Path(__file__).stem)
 
 
+def write_outputs(stats_global: pd.DataFrame, edges: pd.DataFrame,
+                  output_file_stats: Path, output_file_edges: Path,
+                  sketches: Optional[SketchTable] = None):
+    stats_global.to_csv(output_file_stats, index=False)
+    edges.to_csv(output_file_edges, index=False)
+    if sketches is not None:
+        sketches.save(sketch_path(output_file_edges))
+
+    logger.info(
+        f'Data written to: {output_file_stats.absolute()} and {output_file_edges.absolute()}')
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
 
     logger.info(f'Program started.')
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--test', action='store', type=str,
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--test', action='store', type=str,
                         help='test log file path')
+    source.add_argument('--input', action='store', type=str,
+                        help='local log file path (text or zip as written '
+                             'by collect) instead of downloading the log')
+    parser.add_argument('--jobs', action='store', type=int,
+                        help='build graph and analyze partitions '
+                             'in this many processes')
+    parser.add_argument('--partition-by', action='store',
+                        choices=[PARTITION_BY_SUBDOMAIN, PARTITION_BY_HASH],
+                        default=PARTITION_BY_SUBDOMAIN,
+                        help='partitioning used with --jobs')
+    parser.add_argument('--partitions', action='store', type=int,
+                        help='number of hash partitions '
+                             '(default: 4 * jobs, 64 with --out-of-core)')
+    parser.add_argument('--out-of-core', action='store_true', default=False,
+                        help='spill hash partitions of the events to disk '
+                             'and process them one by one (bounded memory)')
+    parser.add_argument('--spill-dir', action='store', type=str,
+                        help='directory for the spill files '
+                             '(default: system temp directory)')
+    parser.add_argument('--chunk-lines', action='store', type=int,
+                        default=100000,
+                        help='log lines parsed at once with --out-of-core')
+    parser.add_argument('--sample-rate', action='store', type=float,
+                        help='fast preview: analyze this fraction of the '
+                             'journeys and scale the results up')
+    parser.add_argument('--sketches', action='store_true', default=False,
+                        help='estimate distinct visitors per edge, node and '
+                             'source type, and save the mergeable sketches '
+                             'alongside the edges file')
+    parser.add_argument('--sketch-precision', action='store', type=int,
+                        default=DEFAULT_PRECISION,
+                        help='HyperLogLog precision (4-16, '
+                             'error ~ 1.04 / sqrt(2 ** precision))')
+    parser.add_argument('--sessions', action='store', type=str,
+                        help='json file with session rule definitions; '
+                             'outputs are written per definition '
+                             'with its name as file name suffix')
     parser.add_argument('output_file_stats',
                         help='output stats csv file')
     parser.add_argument('output_file_edges',
                         help='output edges csv file')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.sessions is not None and args.jobs is not None:
+        parser.error('--sessions cannot be combined with --jobs')
+    if args.out_of_core and (args.sessions is not None or args.jobs is not None):
+        parser.error('--out-of-core cannot be combined with --sessions or --jobs')
+    if args.sample_rate is not None and not 0 < args.sample_rate <= 1:
+        parser.error('--sample-rate has to be in (0, 1]')
+    if not 4 <= args.sketch_precision <= 16:
+        parser.error('--sketch-precision has to be between 4 and 16')
+    sketch_precision = args.sketch_precision if args.sketches else None
+    if args.sessions is not None:
+        try:
+            rules = read_session_rules(Path(args.sessions))
+        except ValueError as e:
+            parser.error(str(e))
+        if args.sample_rate is not None and any('ip' not in r.key_columns
+                                                for r in rules):
+            parser.error('--sample-rate requires ip as journey key column')
+    profiler = get_profiler(args, [
+        find_parts, process_parts, convert_to_df,
+        SessionEngine.identify_journeys, compress_to_phases, get_edges,
+        get_journeys, get_weighted_edges,
+    ])
 
     output_file_stats = Path(args.output_file_stats)
     output_file_edges = Path(args.output_file_edges)
 
+    if args.out_of_core:
+        with ExitStack() as stack:
+            if args.test is not None:
+                input_file = Path(args.test)
+                logger.info(f'Test mode: reading from: {input_file.absolute()}')
+                lines = stack.enter_context(open(input_file))
+            elif args.input is not None:
+                input_file = Path(args.input)
+                logger.info(f'Reading from: {input_file.absolute()}')
+                lines = stack.enter_context(open_log(input_file))
+            else:
+                # streamed to a zip file, the log is never held in memory
+                tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(
+                    dir=args.spill_dir, prefix='dashprep_log_'))
+                with profiler.stage('collect'):
+                    paths = collect_many([LOG_URL], Path(tmp_dir))
+                lines = stack.enter_context(open_log(paths[LOG_URL]))
+            try:
+                with profiler.stage('out_of_core'):
+                    stats_global, edges, sketches = analyze_out_of_core(
+                        iter_chunks(lines, args.chunk_lines),
+                        n_partitions=args.partitions or 64,
+                        spill_dir=args.spill_dir,
+                        sample_rate=args.sample_rate,
+                        sketch_precision=sketch_precision)
+            except ValueError as e:
+                logger.error(e)
+                sys.exit(1)
+        write_outputs(stats_global, edges, output_file_stats, output_file_edges,
+                      sketches)
+        return
+
     if args.test is not None:
         input_file = Path(args.test)
         logger.info(f'Test mode: reading from: {input_file.absolute()}')
         with open(input_file) as f:
             content = f.read()
+    elif args.input is not None:
+        input_file = Path(args.input)
+        logger.info(f'Reading from: {input_file.absolute()}')
+        with open_log(input_file) as f:
+            content = f.read()
     else:
-        content = collect()
+        with profiler.stage('collect'):
+            content = collect()
 
-    df = prepare(content)
-    df = build_graph(df)
-    stats_global, edges = analyze(df)
+    with profiler.stage('prepare'):
+        df = prepare(content, args.sample_rate)
+    if df.empty:
+        logger.error('No events to analyze (empty log or sample).')
+        sys.exit(1)
+    if args.sessions is not None:
+        with profiler.stage('build_graph'):
+            stores = SessionEngine(df).run(rules)
+        for name, store in stores.items():
+            with profiler.stage(f'analyze_{name}'):
+                stats_global, edges, sketches = analyze(
+                    store, args.sample_rate, sketch_precision)
+            write_outputs(
+                stats_global, edges,
+                output_file_stats.with_stem(f'{output_file_stats.stem}_{name}'),
+                output_file_edges.with_stem(f'{output_file_edges.stem}_{name}'),
+                sketches)
+        return
 
-    stats_global.to_csv(output_file_stats, index=False)
-    edges.to_csv(output_file_edges, index=False)
+    if args.jobs is not None:
+        n_partitions = args.partitions or 4 * args.jobs
+        # only the parent process is profiled
+        with profiler.stage('analyze_sharded'):
+            stats_global, edges, sketches = analyze_sharded(
+                df, by=args.partition_by, n_partitions=n_partitions,
+                n_jobs=args.jobs, sample_rate=args.sample_rate,
+                sketch_precision=sketch_precision)
+    else:
+        with profiler.stage('build_graph'):
+            store = build_graph(df)
+        with profiler.stage('analyze'):
+            stats_global, edges, sketches = analyze(
+                store, args.sample_rate, sketch_precision)
 
-    logger.info(
-        f'Data written to: {output_file_stats.absolute()} and {output_file_edges.absolute()}')
+    write_outputs(stats_global, edges, output_file_stats, output_file_edges,
+                  sketches)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+import io
+import logging
+import pickle
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+
+import pandas as pd
+
+from dashprep.analyze import (get_ip_totals, get_journey_totals,
+                              merge_weighted_edges, summarize_totals)
+from dashprep.graph import DEFAULT_RULES, SessionRules
+from dashprep.prepare import prepare
+from dashprep.shard import hash_partition_keys, process_partition
+from dashprep.sketch import SketchTable
+
+
+logger = logging.getLogger(Path(__file__).stem)
+
+
+@contextmanager
+def open_log(path: Path) -> Iterator[TextIO]:
+    """Opens a log file for reading line by line, either plain text
+    or a zip file with a `log.txt` member (as written by collect).
+    """
+
+    path = Path(path)
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf, zf.open('log.txt') as f:
+            yield io.TextIOWrapper(f, encoding='utf8')
+    else:
+        with open(path, encoding='utf8') as f:
+            yield f
+
+
+def iter_chunks(lines: Iterable[str], chunk_lines: int) -> Iterator[str]:
+    """Groups log lines into text chunks of at most `chunk_lines` lines.
+    """
+
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, chunk_lines))
+        if not chunk:
+            return
+        yield ''.join(line if line.endswith('\n') else line + '\n'
+                      for line in chunk)
+
+
+def spill_partitions(chunks: Iterable[str], spill_dir: Path,
+                     n_partitions: int,
+                     rules: SessionRules = DEFAULT_RULES,
+                     sample_rate: Optional[float] = None) -> List[Path]:
+    """Prepares the log chunk by chunk and appends the events
+    to on-disk partition files by the hash of the journey key,
+    so that every journey ends up in exactly one partition.
+    A sample is partitioned by IP address (part of the journey key),
+    so that every IP address ends up in exactly one partition.
+    """
+
+    columns = ['ip'] if sample_rate is not None else None
+    paths = [Path(spill_dir) / f'part_{i:04d}.pkl' for i in range(n_partitions)]
+    n_events = 0
+    for chunk in chunks:
+        df = prepare(chunk, sample_rate)
+        if df.empty:
+            continue
+        keys = hash_partition_keys(df, n_partitions, rules, columns)
+        for i, part in df.groupby(keys, sort=False):
+            with open(paths[i], 'ab') as f:
+                pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+        n_events += len(df)
+
+    logger.info(f'Spilled {n_events} events to {n_partitions} partition(s) '
+                f'in {Path(spill_dir).absolute()}.')
+
+    return [p for p in paths if p.exists()]
+
+
+def read_partition(path: Path) -> pd.DataFrame:
+    """Reads the spilled chunks of a partition.
+    """
+
+    parts = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                parts.append(pickle.load(f))
+            except EOFError:
+                break
+    return pd.concat(parts, ignore_index=True)
+
+
+def analyze_out_of_core(chunks: Iterable[str],
+                        n_partitions: int = 64,
+                        spill_dir: Optional[Path] = None,
+                        rules: SessionRules = DEFAULT_RULES,
+                        sample_rate: Optional[float] = None,
+                        sketch_precision: Optional[int] = None
+                        ) -> Tuple[pd.DataFrame, pd.DataFrame,
+                                   Optional[SketchTable]]:
+    """Runs the pipeline with bounded memory:
+    only one log chunk and then one partition is held in memory,
+    plus the journey totals and the weighted edges.
+    Produces the same output as the in-memory pipeline.
+    """
+
+    if sample_rate is not None and 'ip' not in rules.key_columns:
+        raise ValueError('Sampling requires ip as journey key column.')
+
+    with tempfile.TemporaryDirectory(dir=spill_dir,
+                                     prefix='dashprep_spill_') as tmp_dir:
+        paths = spill_partitions(chunks, Path(tmp_dir), n_partitions, rules,
+                                 sample_rate)
+        if not paths:
+            raise ValueError('No events to analyze (empty log or sample).')
+
+        totals = None
+        ip_totals = None
+        edges = None
+        sketches = None
+        for i, path in enumerate(paths):
+            part_journeys, part_edges, part_sketches = process_partition(
+                i, read_partition(path), rules, sketch_precision,
+                sample_rate)
+            path.unlink()
+
+            part_totals = get_journey_totals(part_journeys)
+            totals = part_totals if totals is None else totals + part_totals
+            if sample_rate is not None:
+                part_ip_totals = get_ip_totals(part_journeys)
+                ip_totals = (part_ip_totals if ip_totals is None
+                             else ip_totals + part_ip_totals)
+            edges = merge_weighted_edges(
+                part_edges if edges is None
+                else pd.concat([edges, part_edges], ignore_index=True))
+            if part_sketches is not None:
+                sketches = (part_sketches if sketches is None
+                            else SketchTable.union([sketches, part_sketches]))
+
+    stats_global, edges = summarize_totals(totals, edges, sample_rate,
+                                           sketches, ip_totals)
+
+    logger.info('Out-of-core analysis completed successfully.')
+
+    return stats_global, edges, sketches
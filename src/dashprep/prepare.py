@@ -1,13 +1,16 @@
 import argparse
 import json
 import logging
+import zlib
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple
+from typing import List, Optional, Tuple
 from zipfile import ZipFile, ZIP_DEFLATED
 
 import pandas as pd
 
+from dashprep.profiling import add_profile_arguments, get_profiler
+
 
 logger = logging.getLogger(Path(__file__).stem)
 
@@ -79,19 +82,50 @@ def _get_content_from_zip(zp: Path) -> str:
     return content
 
 
-def convert_to_df(content: str) -> pd.DataFrame:
+def sample_rows(rows: List[str], sample_rate: float) -> List[str]:
+    """Keeps the rows of a deterministic sample of IP addresses
+    without decoding the json data.
+    The IP address is part of the journey key,
+    so journeys are either kept or dropped as a whole.
+    """
+
+    threshold = int(sample_rate * 2**32)
+
+    def _in_sample(row: str) -> bool:
+        parts = row.lstrip().split(' ', 3)
+        ip = parts[2] if len(parts) > 2 else ''
+        return zlib.crc32(ip.encode('utf8')) < threshold
+
+    return [row for row in rows if _in_sample(row)]
+
+
+def convert_to_df(content: str,
+                  sample_rate: Optional[float] = None,
+                  skip_errors: bool = False) -> pd.DataFrame:
     """Transforms raw log to pandas DataFrame.
+    Rows that cannot be parsed are logged and skipped if `skip_errors`.
     """
 
     rows = content.splitlines(keepends=False)
+    if sample_rate is not None:
+        rows = sample_rows(rows, sample_rate)
 
     records = []
     for text in rows:
         row = text.strip()
-        raw_ts_ip, raw_data, raw_agent = find_parts(row)
-        record = process_parts(raw_ts_ip, raw_data, raw_agent)
+        try:
+            raw_ts_ip, raw_data, raw_agent = find_parts(row)
+            record = process_parts(raw_ts_ip, raw_data, raw_agent)
+        except Exception as e:
+            if not skip_errors:
+                raise
+            logger.error('Skipping row that could not be parsed ({}): {}'
+                         .format(e, row[:200]))
+            continue
         records.append(record)
     df = pd.DataFrame.from_records(records)
+    if df.empty:
+        return df
 
     df['id'] = df['id'].astype(str).str.split('.', expand=True)[0]
 
@@ -224,12 +258,19 @@ def drop_irrelevant_rows(df):
     return df
 
 
-def prepare(content: bytes) -> pd.DataFrame:
+def prepare(content: bytes,
+            sample_rate: Optional[float] = None,
+            skip_errors: bool = False) -> pd.DataFrame:
     """Main data preparation process.
     Transforms the raw event log to pandas DataFrame.
+    Only keeps a sample of the journeys if sample rate is given,
+    skips rows that cannot be parsed if `skip_errors`.
     """
 
-    df = convert_to_df(content)
+    df = convert_to_df(content, sample_rate, skip_errors)
+    if df.empty:
+        logger.info('Data preparation completed, no rows to prepare.')
+        return df
     df = extract_arguments_from_url(df, 'url')
     df = extract_arguments_from_url(df, 'referrer')
     df = drop_irrelevant_rows(df)
@@ -250,7 +291,9 @@ def main():
                         help='input zip file with log.txt content')
     parser.add_argument('output_file', action='store',
                         help='output csv file')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    profiler = get_profiler(args, [find_parts, process_parts, convert_to_df])
 
     input_file = Path(args.input_file)
     output_file = Path(args.output_file)
@@ -260,7 +303,8 @@ def main():
 
     logger.debug(f'Reading from: {input_file.absolute()}')
 
-    df = prepare(content)
+    with profiler.stage('prepare'):
+        df = prepare(content)
 
     df.to_csv(output_file, index=False)
     logger.info(f'Data written to: {output_file.absolute()}')
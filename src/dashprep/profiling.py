@@ -0,0 +1,221 @@
+import argparse
+import cProfile
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(Path(__file__).stem)
+
+PROFILER_CPROFILE = 'cprofile'
+PROFILER_SAMPLING = 'sampling'
+PROFILER_BOTH = 'both'
+
+
+class StackSampler:
+    """Samples the call stack of a thread in the background
+    and counts the collapsed stacks (flamegraph input format).
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} '
+                             f'({Path(code.co_filename).name}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: Path):
+        with open(path, 'w') as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f'{stack} {n}\n')
+
+
+def _function_ranges(functions: List[Callable]
+                     ) -> Dict[str, List[Tuple[int, int, str]]]:
+    """Returns the (first line, last line, name) ranges
+    of the functions by file name.
+    """
+
+    ranges = dict()
+    for func in functions:
+        code = func.__code__
+        lines = [line for (__, __, line) in code.co_lines() if line is not None]
+        ranges.setdefault(code.co_filename, []).append(
+            (code.co_firstlineno, max(lines), func.__qualname__))
+    return ranges
+
+
+def top_allocation_sites(snapshot: tracemalloc.Snapshot,
+                         functions: List[Callable],
+                         limit: int = 10) -> List[Tuple[str, int, int]]:
+    """Attributes the allocations of the snapshot to the innermost
+    calling line within the given functions.
+
+    Returns (site, size, count) tuples, largest first.
+    """
+
+    ranges = _function_ranges(functions)
+    sites = Counter()
+    counts = Counter()
+    for stat in snapshot.statistics('traceback'):
+        for frame in reversed(stat.traceback):
+            for (first, last, name) in ranges.get(frame.filename, []):
+                if first <= frame.lineno <= last:
+                    site = f'{name} ({Path(frame.filename).name}:{frame.lineno})'
+                    sites[site] += stat.size
+                    counts[site] += stat.count
+                    break
+            else:
+                continue
+            break
+    return [(site, size, counts[site]) for (site, size) in sites.most_common(limit)]
+
+
+class Profiler:
+    """Profiles pipeline stages.
+
+    Each stage writes into the output directory:
+        <stage>.pstats: cProfile statistics
+        <stage>.collapsed: sampled stacks for flamegraph tools
+        <stage>.tracemalloc.txt: top allocation sites
+    Without output directory the stages are not profiled.
+    """
+
+    def __init__(self, output_dir: Optional[Path] = None,
+                 profiler: str = PROFILER_CPROFILE,
+                 trace_memory: bool = False,
+                 hot_functions: Optional[List[Callable]] = None,
+                 interval: float = 0.005):
+        self.output_dir = output_dir
+        self.profiler = profiler
+        self.trace_memory = trace_memory
+        self.hot_functions = hot_functions or []
+        self.interval = interval
+        if output_dir is not None:
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.output_dir is not None
+
+    @contextmanager
+    def stage(self, name: str):
+        """Profiles the enclosed block as a pipeline stage.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        profile = None
+        sampler = None
+        if self.profiler in (PROFILER_CPROFILE, PROFILER_BOTH):
+            profile = cProfile.Profile()
+        if self.profiler in (PROFILER_SAMPLING, PROFILER_BOTH):
+            sampler = StackSampler(threading.get_ident(), self.interval)
+        if self.trace_memory:
+            tracemalloc.start(25)
+
+        t0 = time.perf_counter()
+        if sampler is not None:
+            sampler.start()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            if sampler is not None:
+                sampler.stop()
+            elapsed = time.perf_counter() - t0
+            self._write(name, profile, sampler, elapsed)
+
+    def _write(self, name: str,
+               profile: Optional[cProfile.Profile],
+               sampler: Optional[StackSampler],
+               elapsed: float):
+        output_dir = Path(self.output_dir)
+        files = []
+        if profile is not None:
+            files.append(output_dir / f'{name}.pstats')
+            profile.dump_stats(files[-1])
+        if sampler is not None:
+            files.append(output_dir / f'{name}.collapsed')
+            sampler.write(files[-1])
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            __, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            files.append(output_dir / f'{name}.tracemalloc.txt')
+            with open(files[-1], 'w') as f:
+                f.write(f'peak: {peak / 2**20:.1f} MiB\n\n')
+                f.write('top allocation sites in hot functions:\n')
+                for site, size, count in top_allocation_sites(
+                        snapshot, self.hot_functions):
+                    f.write(f'{size / 2**10:12.1f} KiB {count:10d} blocks  {site}\n')
+                f.write('\ntop allocation sites:\n')
+                for stat in snapshot.statistics('lineno')[:20]:
+                    f.write(f'{stat}\n')
+
+        msg = [f'Stage "{name}" profiled ({elapsed:.2f}s).']
+        msg += ['\t> {}'.format(p.absolute()) for p in files]
+        logger.info('\n'.join(msg))
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Adds the profiling options to a command line parser.
+    """
+
+    parser.add_argument('--profile', action='store', type=str,
+                        help='profile the stages and write the results '
+                             'to this directory')
+    parser.add_argument('--profiler', action='store',
+                        choices=[PROFILER_CPROFILE, PROFILER_SAMPLING,
+                                 PROFILER_BOTH],
+                        default=PROFILER_CPROFILE,
+                        help='profiler used with --profile (both skews the '
+                             'results: the sampled stacks include the '
+                             'cProfile overhead and the sampler thread '
+                             'inflates the cProfile timings)')
+    parser.add_argument('--profile-memory', action='store_true',
+                        default=False,
+                        help='record top allocation sites with tracemalloc '
+                             '(slow)')
+
+
+def get_profiler(args: argparse.Namespace,
+                 hot_functions: Optional[List[Callable]] = None) -> Profiler:
+    """Creates the profiler configured by the command line options.
+    """
+
+    output_dir = Path(args.profile) if args.profile is not None else None
+    return Profiler(output_dir,
+                    profiler=args.profiler,
+                    trace_memory=args.profile_memory,
+                    hot_functions=hot_functions)
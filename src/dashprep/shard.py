@@ -0,0 +1,128 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+from dashprep.analyze import (get_edge_sketches, get_journeys,
+                              get_weighted_edges, merge_weighted_edges,
+                              summarize)
+from dashprep.graph import DEFAULT_RULES, SessionRules, build_graph
+from dashprep.sketch import SketchTable
+
+
+logger = logging.getLogger(Path(__file__).stem)
+
+PARTITION_BY_SUBDOMAIN = 'url_subdomain'
+PARTITION_BY_HASH = 'hash'
+
+
+def hash_partition_keys(df: pd.DataFrame, n_partitions: int,
+                        rules: SessionRules = DEFAULT_RULES,
+                        columns: Optional[List[str]] = None) -> pd.Series:
+    """Returns the partition index of the events
+    by the hash of the journey key columns (or a subset of them).
+    Stable across calls, so chunks of the same log can be partitioned
+    separately.
+    """
+
+    keys = df[list(columns or rules.key_columns)].astype(str)
+    return pd.util.hash_pandas_object(keys, index=False) % n_partitions
+
+
+def partition(df: pd.DataFrame,
+              by: str = PARTITION_BY_SUBDOMAIN,
+              n_partitions: Optional[int] = None,
+              rules: SessionRules = DEFAULT_RULES) -> List[pd.DataFrame]:
+    """Splits the prepared event frame into independent partitions.
+
+    Journeys never span partitions: either every `url_subdomain`
+    gets its own partition, or events are bucketed
+    by the hash of the journey key columns.
+    Partitions are returned largest first.
+    """
+
+    if by == PARTITION_BY_SUBDOMAIN:
+        if 'url_subdomain' not in rules.key_columns:
+            raise ValueError('Partitioning by url_subdomain requires it '
+                             'to be a journey key column.')
+        keys = df['url_subdomain']
+    elif by == PARTITION_BY_HASH:
+        if not n_partitions:
+            raise ValueError('Number of partitions is required '
+                             'for hash partitioning.')
+        keys = hash_partition_keys(df, n_partitions, rules)
+    else:
+        raise ValueError(f'Unknown partitioning: {by}')
+
+    parts = [_df for __, _df in df.groupby(keys, dropna=False, sort=False)]
+    parts.sort(key=len, reverse=True)
+    return parts
+
+
+def process_partition(i: int, df: pd.DataFrame,
+                      rules: SessionRules = DEFAULT_RULES,
+                      sketch_precision: Optional[int] = None,
+                      sample_rate: Optional[float] = None
+                      ) -> Tuple[pd.DataFrame, pd.DataFrame,
+                                 Optional[SketchTable]]:
+    """Builds the graph of one partition and aggregates it
+    to journeys, weighted edges and optionally edge sketches
+    (of a sample of the visitors if the sample rate is given).
+    """
+
+    store = build_graph(df.reset_index(drop=True), rules)
+
+    journeys = get_journeys(store)
+    journeys.index = f'{i}:' + journeys.index
+    edges = get_weighted_edges(store)
+    sketches = None
+    if sketch_precision is not None:
+        sketches = get_edge_sketches(store, sketch_precision, sample_rate)
+    return journeys, edges, sketches
+
+
+def _process_partition(args: Tuple[int, pd.DataFrame, SessionRules,
+                                   Optional[int], Optional[float]]
+                       ) -> Tuple[pd.DataFrame, pd.DataFrame,
+                                  Optional[SketchTable]]:
+    return process_partition(*args)
+
+
+def analyze_sharded(df: pd.DataFrame,
+                    by: str = PARTITION_BY_SUBDOMAIN,
+                    n_partitions: Optional[int] = None,
+                    n_jobs: Optional[int] = None,
+                    rules: SessionRules = DEFAULT_RULES,
+                    sample_rate: Optional[float] = None,
+                    sketch_precision: Optional[int] = None
+                    ) -> Tuple[pd.DataFrame, pd.DataFrame,
+                               Optional[SketchTable]]:
+    """Runs graph building and analysis per partition in a process pool
+    and combines the results.
+    Produces the same output as `build_graph` followed by `analyze`.
+    """
+
+    parts = partition(df, by=by, n_partitions=n_partitions, rules=rules)
+    logger.info(f'Processing {len(parts)} partition(s) '
+                f'(largest: {len(parts[0]) if parts else 0} events).')
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(
+            _process_partition,
+            [(i, part, rules, sketch_precision, sample_rate)
+             for (i, part) in enumerate(parts)]))
+
+    journeys = pd.concat([r[0] for r in results])
+    edges = pd.concat([r[1] for r in results], ignore_index=True)
+
+    sketches = None
+    if sketch_precision is not None:
+        sketches = SketchTable.union([r[2] for r in results])
+    stats_global, edges = summarize(journeys, merge_weighted_edges(edges),
+                                    sample_rate, sketches)
+
+    logger.info('Sharded analysis completed successfully.')
+
+    return stats_global, edges, sketches
@@ -0,0 +1,223 @@
+import argparse
+import logging
+from pathlib import Path
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(Path(__file__).stem)
+
+DEFAULT_PRECISION = 10
+
+
+def hash_values(values) -> np.ndarray:
+    """Stable 64 bit hashes of the values (same across runs and machines).
+    """
+
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+def _bit_length(x: np.ndarray) -> np.ndarray:
+    """Number of significant bits of unsigned 64 bit integers.
+    """
+
+    n = np.zeros(x.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = x >= (np.uint64(1) << np.uint64(shift))
+        n[big] += shift
+        x = np.where(big, x >> np.uint64(shift), x)
+    return n + (x > 0)
+
+
+def build_registers(group: np.ndarray, hashes: np.ndarray,
+                    n_groups: int, precision: int) -> np.ndarray:
+    """Builds HyperLogLog registers per group from 64 bit hashes.
+    The first `precision` bits select the register, the position
+    of the first set bit of the rest is the register value.
+    """
+
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n_bits = 64 - precision
+    index = (hashes >> np.uint64(n_bits)).astype(np.int64)
+    rest = hashes & np.uint64((1 << n_bits) - 1)
+    rank = (n_bits - _bit_length(rest) + 1).astype(np.uint8)
+
+    registers = np.zeros((n_groups, 1 << precision), dtype=np.uint8)
+    np.maximum.at(registers, (group, index), rank)
+    return registers
+
+
+def estimate(registers: np.ndarray) -> np.ndarray:
+    """Estimates the distinct counts of the register rows
+    (with linear counting for small cardinalities).
+    """
+
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.sum(np.exp2(-registers.astype(float)), axis=1)
+    zeros = np.count_nonzero(registers == 0, axis=1)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class SketchTable:
+    """HyperLogLog sketches of distinct visitors, one per key row.
+    Sketches are merged by taking the register-wise maximum,
+    so tables of different days or shards can be combined.
+
+    Sketches of a sample of the visitors record the sample rate,
+    the estimates are scaled up to the full data set.
+    """
+
+    def __init__(self, keys: pd.DataFrame, registers: np.ndarray,
+                 sample_rate: float = 1.):
+        self.keys = keys.reset_index(drop=True)
+        self.registers = registers
+        self.sample_rate = sample_rate
+
+    @property
+    def precision(self) -> int:
+        return int(np.log2(self.registers.shape[1]))
+
+    @classmethod
+    def from_groups(cls, keys: pd.DataFrame, group: np.ndarray,
+                    hashes: np.ndarray,
+                    precision: int = DEFAULT_PRECISION,
+                    sample_rate: float = 1.) -> 'SketchTable':
+        """Builds the sketches of the visitor hashes by group,
+        where `keys` has one row per group index.
+        """
+
+        return cls(keys, build_registers(group, hashes, len(keys), precision),
+                   sample_rate)
+
+    def rollup(self, columns: Sequence[str]) -> 'SketchTable':
+        """Merges the sketches with the same values in the columns
+        (all sketches into a single row without columns).
+        """
+
+        if not columns:
+            registers = np.zeros((1, self.registers.shape[1]), dtype=np.uint8)
+            if len(self.registers):
+                registers = self.registers.max(axis=0, keepdims=True)
+            return SketchTable(pd.DataFrame(index=range(1)), registers,
+                               self.sample_rate)
+
+        keys = self.keys[list(columns)]
+        if keys.empty:
+            return SketchTable(keys, self.registers[:0], self.sample_rate)
+
+        group = keys.groupby(list(columns), dropna=False, sort=True).ngroup()
+        group = group.to_numpy()
+        order = np.argsort(group, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(group[order]) != 0])
+        registers = np.maximum.reduceat(self.registers[order], starts, axis=0)
+        return SketchTable(keys.iloc[order[starts]], registers,
+                           self.sample_rate)
+
+    @staticmethod
+    def union(tables: List['SketchTable']) -> 'SketchTable':
+        """Merges sketch tables with the same key columns,
+        precision and sample rate.
+        """
+
+        precisions = {t.precision for t in tables}
+        if len(precisions) > 1:
+            raise ValueError(f'Cannot merge sketches of different precision: '
+                             f'{sorted(precisions)}')
+        sample_rates = {t.sample_rate for t in tables}
+        if len(sample_rates) > 1:
+            raise ValueError(f'Cannot merge sketches of different sample rate: '
+                             f'{sorted(sample_rates)}')
+        keys = pd.concat([t.keys for t in tables], ignore_index=True)
+        registers = np.concatenate([t.registers for t in tables])
+        return (SketchTable(keys, registers, sample_rates.pop())
+                .rollup(list(keys.columns)))
+
+    def to_frame(self, name: str = 'unique_visitors') -> pd.DataFrame:
+        """Returns the keys with the estimated distinct counts
+        (scaled up by the sample rate).
+        """
+
+        df = self.keys.copy()
+        df[name] = estimate(self.registers) / self.sample_rate
+        return df
+
+    def save(self, path: Path):
+        """Saves the sketches to a numpy npz file
+        (string key columns, missing values flagged separately).
+        """
+
+        arrays = {'registers': self.registers,
+                  'sample_rate': np.float64(self.sample_rate),
+                  'columns': np.array(self.keys.columns, dtype=str)}
+        for i, col in enumerate(self.keys.columns):
+            missing = self.keys[col].isna().to_numpy()
+            arrays[f'key_{i}'] = self.keys[col].fillna('').astype(str).to_numpy(dtype=str)
+            arrays[f'missing_{i}'] = missing
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path: Path) -> 'SketchTable':
+        with np.load(path, allow_pickle=False) as f:
+            keys = pd.DataFrame({
+                col: np.where(f[f'missing_{i}'], None,
+                              f[f'key_{i}'].astype(object))
+                for (i, col) in enumerate(f['columns'].tolist())
+            })
+            sample_rate = float(f['sample_rate']) if 'sample_rate' in f else 1.
+            return cls(keys, f['registers'], sample_rate)
+
+
+def sketch_path(edges_path: Path) -> Path:
+    """Path of the sketch file written alongside an edges csv.
+    """
+
+    edges_path = Path(edges_path)
+    return edges_path.with_name(edges_path.stem + '.hll.npz')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description='merge and query distinct visitor sketch files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge = subparsers.add_parser('merge', help='merge sketch files')
+    merge.add_argument('output_file', help='output sketch file')
+    merge.add_argument('input_files', nargs='+', help='input sketch files')
+    query = subparsers.add_parser('query', help='estimate distinct visitors')
+    query.add_argument('input_files', nargs='+', help='input sketch files')
+    query.add_argument('--by', nargs='*',
+                       help='key columns to group by (default: all, '
+                            'none for the total)')
+    query.add_argument('--output-file', help='output csv file')
+    args = parser.parse_args()
+
+    try:
+        table = SketchTable.union([SketchTable.load(p)
+                                   for p in args.input_files])
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.command == 'merge':
+        output_file = Path(args.output_file)
+        table.save(output_file)
+        logger.info(f'Data written to: {output_file.absolute()}')
+        return
+
+    if args.by is not None:
+        table = table.rollup(args.by)
+    df = table.to_frame()
+    if args.output_file is not None:
+        df.to_csv(args.output_file, index=False)
+        logger.info(f'Data written to: {Path(args.output_file).absolute()}')
+    else:
+        print(df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
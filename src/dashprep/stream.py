@@ -0,0 +1,309 @@
+import argparse
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+from urllib.request import Request, urlopen
+
+import pandas as pd
+
+from dashprep.analyze import (EDGE_KEY_COLUMNS, get_journey_totals,
+                              get_journeys, get_weighted_edges,
+                              merge_weighted_edges, summarize_totals)
+from dashprep.graph import (DEFAULT_RULES, SessionEngine, SessionRules,
+                            compress_to_phases, get_edges, identify_phases)
+from dashprep.prepare import prepare
+
+
+logger = logging.getLogger(Path(__file__).stem)
+
+
+class FileTail:
+    """Reads the bytes appended to a log file since the last read.
+    Starts over if the file was truncated or replaced.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.offset = 0
+        self._inode = None
+
+    def read_new(self) -> bytes:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return b''
+        if stat.st_ino != self._inode or stat.st_size < self.offset:
+            self._inode = stat.st_ino
+            self.offset = 0
+        if stat.st_size == self.offset:
+            return b''
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            content = f.read()
+        self.offset += len(content)
+        return content
+
+
+class UrlTail:
+    """Polls a log url and returns the bytes appended since the last poll,
+    using range requests where the server supports them.
+    Starts over if the log got shorter (rotated or truncated).
+    """
+
+    def __init__(self, url: str, timeout: float = 30.):
+        self.url = url
+        self.timeout = timeout
+        self.offset = 0
+
+    def read_new(self) -> bytes:
+        request = Request(self.url, headers={'Range': f'bytes={self.offset}-'})
+        try:
+            with urlopen(request, timeout=self.timeout) as resp:
+                content = resp.read()
+                partial = resp.status == 206
+        except OSError as e:
+            if getattr(e, 'code', None) == 416:  # nothing new, or rotated
+                size = self._content_size(e.headers.get('Content-Range', ''))
+                if size is not None and size < self.offset:
+                    logger.info('Log was rotated, reading from the start.')
+                    self.offset = 0
+                return b''
+            logger.error('Could not poll log file ({})'.format(e))
+            return b''
+        if not partial:
+            if len(content) < self.offset:  # log was rotated
+                self.offset = 0
+            content = content[self.offset:]
+        self.offset += len(content)
+        return content
+
+    @staticmethod
+    def _content_size(content_range: str) -> Optional[int]:
+        """Parses the total size of a `bytes */N` content range.
+        """
+
+        try:
+            return int(content_range.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+
+def write_atomic(df: pd.DataFrame, path: Path):
+    """Writes the csv to a temporary file and moves it into place,
+    so readers never see a partially written file.
+    """
+
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+class StreamState:
+    """In-memory state of the streaming pipeline.
+
+    Events of open journeys are kept, closed journeys
+    (terminated, or timed out relative to the newest event)
+    are folded into journey totals and weighted edge aggregates,
+    so the state does not grow with the number of closed journeys.
+    """
+
+    def __init__(self, rules: SessionRules = DEFAULT_RULES):
+        self.rules = rules
+        self.pending = None
+        self.totals = get_journey_totals(pd.DataFrame({
+            'abandoned': pd.Series(dtype=bool),
+            'total_steps': pd.Series(dtype='int64'),
+            'total_time': pd.Series(dtype=float),
+        }))
+        self.edges = None
+        self.watermark = None
+        self._partial = b''
+        self._ingested = []
+
+    def ingest(self, content: bytes, received: float):
+        """Parses the complete lines of the new content
+        and adds the events to the open journeys.
+        Lines that cannot be parsed are logged and skipped.
+        """
+
+        content = self._partial + content
+        content, sep, self._partial = content.rpartition(b'\n')
+        if not sep:
+            return
+        text = content.decode('utf8', errors='replace').strip()
+        if not text:
+            return
+
+        try:
+            df = prepare(text, skip_errors=True)
+        except Exception as e:
+            logger.error('Skipping {} line(s) that could not be prepared ({})'
+                         .format(text.count('\n') + 1, e))
+            return
+        if df.empty:
+            return
+
+        self.pending = (df if self.pending is None
+                        else pd.concat([self.pending, df], ignore_index=True))
+        self.watermark = self.pending['timestamp'].max()
+        self._ingested.append(received)
+
+    def _build(self, df: pd.DataFrame
+               ) -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
+        """Returns the journey totals and weighted edges of the events.
+        """
+
+        df = identify_phases(df, rules=self.rules)
+        if df.empty:
+            return self.totals * 0, None
+        store = get_edges(compress_to_phases(df, rules=self.rules))
+        return get_journey_totals(get_journeys(store)), get_weighted_edges(store)
+
+    def _split(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Sessionizes the pending events
+        and splits them into closed and open journeys.
+        """
+
+        df = SessionEngine(self.pending).identify_journeys(self.rules)
+        df['_term'] = df['event'].isin(self.rules.terminator_events)
+        journeys = df.groupby('journey_id').agg(
+            last_ts=('timestamp', 'max'), term=('_term', 'max'))
+        timeout = pd.to_timedelta(self.rules.timeout)
+        closed_ids = journeys.index[
+            journeys['term'] | (self.watermark - journeys['last_ts'] > timeout)]
+        closed = df['journey_id'].isin(closed_ids)
+        df = df.drop(columns=['_term'])
+        return df[closed], df[~closed]
+
+    def _merge_edges(self, edges: List[Optional[pd.DataFrame]]
+                     ) -> Optional[pd.DataFrame]:
+        edges = [e for e in edges if e is not None]
+        if not edges:
+            return None
+        return merge_weighted_edges(pd.concat(edges, ignore_index=True))
+
+    def flush(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Folds closed journeys into the aggregates and returns
+        the current stats and edges (open journeys counted as if
+        they stopped now).
+        """
+
+        open_totals, open_edges = self.totals * 0, None
+        if self.pending is not None and not self.pending.empty:
+            closed, open_ = self._split()
+            if not closed.empty:
+                totals, edges = self._build(closed)
+                self.totals = self.totals + totals
+                self.edges = self._merge_edges([self.edges, edges])
+            if not open_.empty:
+                open_totals, open_edges = self._build(open_)
+            self.pending = open_.drop(
+                columns=['journey_id', 'total_time', 'total_steps',
+                         'flg_cart_event', 'visitor_hash'])
+
+        edges = self._merge_edges([self.edges, open_edges])
+        if edges is None:
+            edges = pd.DataFrame(columns=EDGE_KEY_COLUMNS + ['freq'])
+
+        return summarize_totals(self.totals + open_totals, edges)
+
+    def pop_ingest_times(self) -> List[float]:
+        ingested, self._ingested = self._ingested, []
+        return ingested
+
+
+def follow(source, output_file_stats: Path, output_file_edges: Path,
+           interval: float = 10., poll: float = 1.,
+           rules: SessionRules = DEFAULT_RULES,
+           iterations: Optional[int] = None):
+    """Tails the source, parses new lines in micro-batches every `poll`
+    seconds and rewrites the outputs every `interval` seconds.
+    Stops after `iterations` writes if given, otherwise runs until
+    interrupted.
+    """
+
+    state = StreamState(rules)
+    next_write = time.monotonic()
+    n_writes = 0
+    try:
+        while iterations is None or n_writes < iterations:
+            content = source.read_new()
+            if content:
+                state.ingest(content, time.time())
+
+            if time.monotonic() >= next_write:
+                ingested = state.pop_ingest_times()
+                if ingested or n_writes == 0:
+                    _publish(state, output_file_stats, output_file_edges,
+                             ingested)
+                n_writes += 1
+                next_write += interval
+            time.sleep(max(0., min(poll, next_write - time.monotonic())))
+    except KeyboardInterrupt:
+        logger.info('Stopping, writing final results.')
+        state.ingest(b'\n', time.time())  # unterminated last line
+        _publish(state, output_file_stats, output_file_edges,
+                 state.pop_ingest_times())
+
+
+def _publish(state: StreamState, output_file_stats: Path,
+             output_file_edges: Path, ingested: List[float]):
+    """Writes the current results and logs the latencies.
+    """
+
+    stats_global, edges = state.flush()
+    write_atomic(stats_global, output_file_stats)
+    write_atomic(edges, output_file_edges)
+
+    published = time.time()
+    msg = ['Dashboard data updated.']
+    msg += [
+        '\t> open journey events: {}'.format(
+            0 if state.pending is None else len(state.pending)),
+        '\t> closed journeys: {}'.format(int(state.totals['n'].sum())),
+    ]
+    if ingested:
+        msg += ['\t> ingest to dashboard latency: max {:.2f}s, min {:.2f}s'
+                .format(published - min(ingested), published - max(ingested))]
+    if state.watermark is not None:
+        age = datetime.now() - state.watermark.to_pydatetime()
+        msg += ['\t> event to dashboard latency (newest event): {:.1f}s'
+                .format(age.total_seconds())]
+    logger.info('\n'.join(msg))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_file_stats',
+                        help='output stats csv file')
+    parser.add_argument('output_file_edges',
+                        help='output edges csv file')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', action='store', type=str,
+                        help='growing log file to tail')
+    source.add_argument('--url', action='store', type=str,
+                        help='log url to poll')
+    parser.add_argument('--interval', action='store', type=float, default=10.,
+                        help='seconds between output updates')
+    parser.add_argument('--poll', action='store', type=float, default=1.,
+                        help='seconds between reads of the source')
+    args = parser.parse_args()
+
+    if args.file is not None:
+        source = FileTail(Path(args.file))
+        logger.info(f'Following: {source.path.absolute()}')
+    else:
+        source = UrlTail(args.url)
+        logger.info(f'Polling: {args.url}')
+
+    follow(source, Path(args.output_file_stats), Path(args.output_file_edges),
+           interval=args.interval, poll=args.poll)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zipfile import ZipFile
+
+import pytest
+
+from dashprep.collect import _ConnectionPool, collect_many
+
+
+class _LogHandler(BaseHTTPRequestHandler):
+    """Serves a log whose content depends on the full request target.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = f'2022-01-01 00:00:00 {self.path}\n'.encode('utf8') * 1000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def log_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _LogHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_collect_many_keeps_sources_apart(log_server, tmp_path):
+    targets = ['/a/log.txt', '/a/log.txt?day=1', '/a/log.txt?day=2',
+               '/a-log.txt']
+    urls = [log_server + t for t in targets]
+
+    paths = collect_many(urls, tmp_path, max_concurrency=4, retries=0)
+
+    assert len(set(paths.values())) == len(urls)
+    for url, target in zip(urls, targets):
+        with ZipFile(paths[url]) as zf:
+            content = zf.read('log.txt').decode('utf8')
+        assert content.splitlines()[-1].endswith(' ' + target)
+    assert not list(tmp_path.glob('*.part'))
+
+
+def test_connection_pool_is_thread_safe():
+    pool = _ConnectionPool(timeout=1.)
+    conns = [pool.acquire('http', 'example.com') for __ in range(100)]
+    for conn in conns:
+        pool.release('http', 'example.com', conn, reusable=True)
+
+    acquired = []
+
+    def worker():
+        for __ in range(10):
+            acquired.append(pool.acquire('http', 'example.com'))
+
+    threads = [threading.Thread(target=worker) for __ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len({id(c) for c in acquired}) == 100
+    pool.close()
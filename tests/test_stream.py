@@ -0,0 +1,170 @@
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from dashprep.analyze import EDGE_KEY_COLUMNS, analyze
+from dashprep.graph import build_graph
+from dashprep.prepare import prepare
+from dashprep.stream import StreamState, UrlTail
+
+
+AGENTS = [
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 Chrome/102.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 15_0 like Mac OS X) Mobile/15E148',
+]
+REFERRERS = ['', 'https://www.google.com/', 'https://facebook.com/']
+
+
+def _line(ts: datetime, ip: str, cid: int, event: str, site: str,
+          referrer: str, agent: str, n: int) -> str:
+    data = {'event': event, 'id': f'{cid}_{n}', 'referrer': referrer}
+    if event == 'index_view':
+        data['url'] = f'http://{site}.example.com/'
+    elif event == 'category_view':
+        data['category'] = random.choice(['Bags', 'Hats', 'Shoes'])
+        data['url'] = f'http://{site}.example.com/category/{data["category"]}'
+    elif event == 'product_view':
+        data['name'] = random.choice(['Tote', 'Cap', 'Red Shoe', 'Boot'])
+        data['url'] = f'http://{site}.example.com/product/{data["name"]}'
+    else:
+        data['url'] = f'http://{site}.example.com/cart'
+    record = {'cid': str(cid), 'id': 'TEST', 'data': data}
+    return f'{ts:%Y-%m-%d %H:%M:%S} {ip} {json.dumps(record)} {agent}\n'
+
+
+def _make_log(n_journeys: int = 300, seed: int = 0) -> bytes:
+    """Generates a log of random journeys in time order,
+    with returning visitors and gaps longer than the session timeout.
+    """
+
+    random.seed(seed)
+    events = ['index_view', 'category_view', 'product_view', 'product_in_cart']
+    rows = []
+    start = datetime(2022, 1, 1)
+    for j in range(n_journeys):
+        ts = start + timedelta(minutes=random.randrange(48 * 60))
+        ip = f'10.0.0.{random.randrange(40)}'
+        cid = random.randrange(60)
+        site = random.choice(['shop', 'store'])
+        referrer = random.choice(REFERRERS)
+        agent = random.choice(AGENTS)
+        for n in range(random.randint(1, 8)):
+            event = random.choice(events)
+            rows.append((ts, _line(ts, ip, cid, event, site, referrer, agent, n)))
+            ts += timedelta(seconds=random.randint(1, 600))
+            if event == 'product_in_cart':
+                break
+    rows.sort(key=lambda r: r[0])
+    return ''.join(line for (__, line) in rows).encode('utf8')
+
+
+def _sorted(edges: pd.DataFrame) -> pd.DataFrame:
+    return edges.sort_values(EDGE_KEY_COLUMNS).reset_index(drop=True)
+
+
+def _stream(content: bytes, chunk_size: int):
+    state = StreamState()
+    for i in range(0, len(content), chunk_size):
+        state.ingest(content[i:i + chunk_size], 0.)
+        stats_global, edges = state.flush()
+    return stats_global, edges
+
+
+@pytest.fixture(scope='module')
+def log() -> bytes:
+    return _make_log()
+
+
+@pytest.fixture(scope='module')
+def batch(log):
+    stats_global, edges, __ = analyze(build_graph(prepare(log.decode('utf8'))))
+    return stats_global, edges
+
+
+def test_incremental_flush_matches_batch(log, batch):
+    stats_global, edges = _stream(log, chunk_size=5000)
+
+    pd.testing.assert_frame_equal(stats_global, batch[0])
+    pd.testing.assert_frame_equal(_sorted(edges), _sorted(batch[1]),
+                                  check_dtype=False)
+
+
+@pytest.mark.parametrize('bad_line', [
+    b'2022-01-01 00:00:00 10.0.0.1 {"cid": "0", "data": {broken json\n',
+    b'\xff\xfe bad\n',
+])
+def test_bad_lines_are_skipped(log, batch, bad_line):
+    lines = log.splitlines(keepends=True)
+    middle = len(lines) // 2
+    content = b''.join(lines[:middle] + [bad_line] + lines[middle:])
+
+    stats_global, edges = _stream(content, chunk_size=5000)
+
+    pd.testing.assert_frame_equal(stats_global, batch[0])
+    pd.testing.assert_frame_equal(_sorted(edges), _sorted(batch[1]),
+                                  check_dtype=False)
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """Serves the server's content with support for open byte ranges.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        content = self.server.content
+        start = 0
+        range_ = self.headers.get('Range')
+        if range_ is not None:
+            start = int(range_.split('=')[1].rstrip('-'))
+        if start >= len(content) and range_ is not None:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(content)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = content[start:]
+        self.send_response(206 if range_ is not None else 200)
+        if range_ is not None:
+            self.send_header('Content-Range',
+                             f'bytes {start}-{len(content) - 1}/{len(content)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def log_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    server.content = b''
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_url_tail_follows_rotation(log_server):
+    tail = UrlTail(f'http://127.0.0.1:{log_server.server_address[1]}/log.txt')
+
+    log_server.content = b'line 1\nline 2\n'
+    assert tail.read_new() == b'line 1\nline 2\n'
+    assert tail.read_new() == b''
+
+    log_server.content += b'line 3\n'
+    assert tail.read_new() == b'line 3\n'
+
+    # rotated to a shorter log: the next poll starts over
+    log_server.content = b'new 1\n'
+    received = tail.read_new()
+    received += tail.read_new()
+    assert received == b'new 1\n'
+    assert tail.read_new() == b''